@@ -6,16 +6,40 @@ import inspect
 import json
 import logging
 import os
+import tempfile
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 import requests
 import torch
+from requests.adapters import HTTPAdapter, Retry
 
 from matgl.config import MATGL_CACHE, PRETRAINED_MODELS_BASE_URL
 
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
 logger = logging.getLogger(__file__)
 
+# mkstemp creates files readable only by the owner; downloaded files get the usual umask-based permissions instead.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Shared session so that repeated downloads from the same host reuse pooled connections. Transient connection errors
+# and 5xx responses are retried with backoff.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
 
 class IOMixIn:
     """Mixin class for model saving and loading.
@@ -135,35 +159,125 @@ class IOMixIn:
 class RemoteFile:
     """Handling of download of remote files to a local cache."""
 
-    def __init__(self, uri: str, cache_location: str | Path = MATGL_CACHE, force_download: bool = False):
+    def __init__(
+        self,
+        uri: str,
+        cache_location: str | Path = MATGL_CACHE,
+        force_download: bool = False,
+        check_stale: bool = False,
+    ):
         """
         Args:
-            uri: Uniform resource identifier.
+            uri: Uniform resource identifier. Local paths and file:// URIs are used in place without any download or
+            caching, i.e., cache_location, force_download and check_stale are ignored and cache_location, etag_path
+            and last_modified_path are set to None.
             cache_location: Directory to cache downloaded RemoteFile. By default, downloaded models are saved at
             $HOME/.matgl.
             force_download: To speed up access, a model with the same name in the cache location will be used if
             present. If you want to force a re-download, set this to True.
+            check_stale: If True and a cached file is present, a conditional request using the ETag and/or
+            Last-Modified validators stored from the previous download is sent and the file is only re-downloaded if
+            it has changed on the remote. If no validator was stored (e.g., files cached by older versions or servers
+            that send neither header), the file is re-downloaded in full.
         """
         self.uri = uri
+        self.downloaded = False
+        parsed = urlparse(uri)
+        if parsed.scheme in ("", "file") or Path(uri).exists():
+            # Local files are used in place and never copied into the cache.
+            self.local_path = Path(url2pathname(parsed.path)) if parsed.scheme == "file" else Path(uri)
+            if not self.local_path.exists():
+                raise requests.RequestException(f"Bad uri: {self.uri}")
+            self.model_name = self.local_path.resolve().parent.name
+            self.fname = self.local_path.name
+            self.cache_location = None
+            self.etag_path = None
+            self.last_modified_path = None
+            logger.info(f"Using local file at {self.local_path}...")
+            return
+
         toks = uri.split("/")
         self.model_name = toks[-2]
         self.fname = toks[-1]
         self.cache_location = Path(cache_location)
         self.local_path = self.cache_location / self.model_name / self.fname
+        self.etag_path = self.local_path.with_name(f"{self.fname}.etag")
+        self.last_modified_path = self.local_path.with_name(f"{self.fname}.last_modified")
         if (not self.local_path.exists()) or force_download:
             logger.info("Downloading from remote location...")
             self._download()
+        elif check_stale:
+            headers = {}
+            if self.etag_path.exists():
+                headers["If-None-Match"] = self.etag_path.read_text()
+            if self.last_modified_path.exists():
+                headers["If-Modified-Since"] = self.last_modified_path.read_text()
+            if headers:
+                logger.info(f"Checking remote location for updates to cached local file at {self.local_path}...")
+            else:
+                logger.warning(
+                    f"No ETag or Last-Modified stored for cached local file at {self.local_path}. "
+                    "Re-downloading in full to check for updates..."
+                )
+            self._download(headers)
         else:
             logger.info(f"Using cached local file at {self.local_path}...")
 
-    def _download(self):
-        r = requests.get(self.uri)
-        if r.status_code == 200:
+    @classmethod
+    def fetch_many(cls, uris: Sequence[str], max_workers: int = 8, **kwargs) -> list[RemoteFile]:
+        """Fetch several remote files concurrently.
+
+        Args:
+            uris: Uniform resource identifiers.
+            max_workers: Maximum number of concurrent downloads.
+            **kwargs: Additional kwargs passed to RemoteFile, e.g., cache_location or force_download.
+
+        Returns:
+            List of RemoteFile, in the same order as uris.
+
+        Raises:
+            The first exception raised (in the order of uris). Files downloaded by this call are then removed, so
+            that an incomplete set of files (e.g., a model without its state) is not left behind in the cache.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(cls, uri, **kwargs) for uri in uris]
+        errors = [e for e in (f.exception() for f in futures) if e is not None]
+        if errors:
+            for f in futures:
+                if f.exception() is None and f.result().downloaded:
+                    remote_file = f.result()
+                    for path in (remote_file.local_path, remote_file.etag_path, remote_file.last_modified_path):
+                        path.unlink(missing_ok=True)
+            raise errors[0]
+        return [f.result() for f in futures]
+
+    def _download(self, headers: dict[str, str] | None = None):
+        with _SESSION.get(self.uri, headers=headers or {}, stream=True, allow_redirects=True, timeout=(5, 60)) as r:
+            if r.status_code == 304:
+                logger.info(f"Cached local file at {self.local_path} is up to date...")
+                return
+            if r.status_code != 200:
+                raise requests.RequestException(f"Bad uri: {self.uri}")
             os.makedirs(self.cache_location / self.model_name, exist_ok=True)
-            with open(self.local_path, "wb") as f:
-                f.write(r.content)
-        else:
-            raise requests.RequestException(f"Bad uri: {self.uri}")
+            # Stream into a uniquely named temporary file and only move it into place once complete, so that an
+            # interrupted download or a concurrent download of the same file never leaves a corrupt file in the cache.
+            fd, tmp_name = tempfile.mkstemp(dir=self.local_path.parent, prefix=self.fname, suffix=".part")
+            tmp_path = Path(tmp_name)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+                os.replace(tmp_path, self.local_path)
+                self.downloaded = True
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            # Store the validators used by check_stale for conditional requests.
+            for header, path in (("ETag", self.etag_path), ("Last-Modified", self.last_modified_path)):
+                if header in r.headers:
+                    path.write_text(r.headers[header])
+                else:
+                    path.unlink(missing_ok=True)
 
     def __enter__(self):
         """Support with context.
@@ -239,7 +353,8 @@ def _get_file_paths(path: Path, **kwargs):
         return {fn: path / fn for fn in fnames}
 
     try:
-        return {fn: RemoteFile(f"{PRETRAINED_MODELS_BASE_URL}{path}/{fn}", **kwargs).local_path for fn in fnames}
+        remote_files = RemoteFile.fetch_many([f"{PRETRAINED_MODELS_BASE_URL}{path}/{fn}" for fn in fnames], **kwargs)
+        return {fn: remote_file.local_path for fn, remote_file in zip(fnames, remote_files)}
     except requests.RequestException:
         raise ValueError(f"No valid model found in pre-trained_models at {PRETRAINED_MODELS_BASE_URL}.") from None
 
@@ -271,5 +386,7 @@ def get_available_pretrained_models() -> list[str]:
     Returns:
         List of available models.
     """
-    r = requests.get("https://api.github.com/repos/materialsvirtuallab/matgl/contents/pretrained_models")
+    r = _SESSION.get(
+        "https://api.github.com/repos/materialsvirtuallab/matgl/contents/pretrained_models", timeout=(5, 60)
+    )
     return [d["name"] for d in json.loads(r.content.decode("utf-8")) if d["type"] == "dir"]
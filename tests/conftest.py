@@ -5,8 +5,8 @@ Define commonly used text fixtures. These are meant to be reused in unittests.
 - Fixtures that are prefixed with `graph_` returns a (structure, graph, state) tuple.
 
 Given that the fixtures are unlikely to be modified by the underlying code, the fixtures are set with a scope of
-"session". In the event that future tests are written that modifies the fixtures, these can be set to the default scope
-of "function".
+"session". Tests that modify the graph data of a fixture should work on a copy, e.g., `g = copy.deepcopy(g)`, to avoid
+leaking state into other tests.
 """
 from __future__ import annotations
 
@@ -23,6 +23,19 @@ from pymatgen.util.testing import PymatgenTest
 matgl.clear_cache(confirm=False)
 
 
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False, help="run tests marked as slow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip_slow = pytest.mark.skip(reason="need --runslow option to run")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
 def get_graph(structure, cutoff):
     """
     Helper class to generate DGL graph from an input Structure or Molecule.
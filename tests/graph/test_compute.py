@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import copy
+import os
 from functools import partial
+from pathlib import Path
 
 import matgl
 import numpy as np
@@ -18,21 +21,84 @@ from matgl.graph.compute import (
 )
 from pymatgen.core import Lattice, Structure
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the reference kernels then run as plain Python.
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+this_dir = Path(os.path.abspath(os.path.dirname(__file__)))
+
+devices = [
+    "cpu",
+    pytest.param("cuda", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")),
+]
+
+
+def _segment_pairs(bin_count):
+    """
+    Enumerate all (i, j) pairs within contiguous segments of the given sizes, in row-major order per segment.
+    Args:
+        bin_count: Number of elements in each segment.
+    Returns: two arrays with the global indices of the first and second element of each pair.
+    """
+    n_pairs = bin_count**2
+    seg_size = np.repeat(bin_count, n_pairs)
+    seg_start = np.repeat(np.cumsum(bin_count) - bin_count, n_pairs)
+    local = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    return seg_start + local // seg_size, seg_start + local % seg_size
+
 
 def _loop_indices(bond_atom_indices, pair_dist, cutoff=4.0):
     bin_count = np.bincount(bond_atom_indices[:, 0], minlength=bond_atom_indices[-1, 0] + 1)
-    indices = []
-    start = 0
-    for bcont in bin_count:
-        for i in range(bcont):
-            for j in range(bcont):
-                if start + i == start + j:
-                    continue
-                if pair_dist[start + i] > cutoff or pair_dist[start + j] > cutoff:
-                    continue
-                indices.append([start + i, start + j])
-        start += bcont
-    return np.array(indices)
+    idx_i, idx_j = _segment_pairs(bin_count)
+    mask = (pair_dist[idx_i] <= cutoff) & (pair_dist[idx_j] <= cutoff) & (idx_i != idx_j)
+    return np.stack([idx_i[mask], idx_j[mask]], axis=1)
+
+
+def _calculate_cos(graph, threebody_cutoff=4.0):
+    """
+    Calculate the cosine theta of triplets using vectorized tensor operations
+    Args:
+        graph: DGL graph with bond_vec edge data
+        threebody_cutoff: cutoff for three-body interactions
+    Returns: an array of cosine theta values, in the same order as _calculate_cos_loop.
+    """
+    _, n_sites = torch.unique(graph.edges()[0], return_counts=True)
+    bond_vec = graph.edata["bond_vec"].detach()
+    idx_i, idx_j = (torch.as_tensor(idx, device=bond_vec.device) for idx in _segment_pairs(n_sites.cpu().numpy()))
+    norms = torch.linalg.norm(bond_vec, dim=1)
+    mask = (norms[idx_i] <= threebody_cutoff) & (norms[idx_j] <= threebody_cutoff) & (idx_i != idx_j)
+    idx_i, idx_j = idx_i[mask], idx_j[mask]
+    # gather each coordinate from its own contiguous 1D tensor rather than rows of the (E, 3) bond_vec
+    bx, by, bz = (b.contiguous() for b in bond_vec.unbind(dim=1))
+    dot = bx[idx_i] * bx[idx_j] + by[idx_i] * by[idx_j] + bz[idx_i] * bz[idx_j]
+    return (dot / (norms[idx_i] * norms[idx_j])).cpu().numpy()
+
+
+def _calculate_cos_bmm(graph, threebody_cutoff=4.0):
+    """
+    Calculate the cosine theta of triplets as a batched matrix product of the padded bond vectors of each atom
+    Args:
+        graph: DGL graph with bond_vec edge data
+        threebody_cutoff: cutoff for three-body interactions
+    Returns: an array of cosine theta values, in the same order as _calculate_cos_loop.
+    """
+    _, n_sites = torch.unique(graph.edges()[0], return_counts=True)
+    bond_vec = graph.edata["bond_vec"].detach()
+    norms = torch.linalg.norm(bond_vec, dim=1)
+    max_bonds = int(n_sites.max())
+    valid = torch.arange(max_bonds, device=bond_vec.device)[None, :] < n_sites[:, None].to(bond_vec.device)
+    vecs = bond_vec.new_zeros(len(n_sites), max_bonds, 3)
+    vecs[valid] = bond_vec
+    padded_norms = norms.new_ones(len(n_sites), max_bonds)
+    padded_norms[valid] = norms
+    cos = torch.bmm(vecs, vecs.transpose(1, 2)) / (padded_norms[:, :, None] * padded_norms[:, None, :])
+    in_cutoff = valid & (padded_norms <= threebody_cutoff)
+    off_diagonal = ~torch.eye(max_bonds, dtype=torch.bool, device=bond_vec.device)
+    return cos[in_cutoff[:, :, None] & in_cutoff[:, None, :] & off_diagonal].cpu().numpy()
 
 
 def _calculate_cos_loop(graph, threebody_cutoff=4.0):
@@ -40,29 +106,39 @@ def _calculate_cos_loop(graph, threebody_cutoff=4.0):
     Calculate the cosine theta of triplets using loops
     Args:
         graph: List
-    Returns: a list of cosine theta values.
+    Returns: an array of cosine theta values.
     """
     _, _, n_sites = torch.unique(graph.edges()[0], return_inverse=True, return_counts=True)
+    bond_vec = graph.edata["bond_vec"].detach()
+    norms = torch.linalg.norm(bond_vec, dim=1).numpy()
+    return _calculate_cos_kernel(bond_vec.numpy(), norms, n_sites.numpy(), threebody_cutoff)
+
+
+@njit(cache=True)
+def _calculate_cos_kernel(bond_vec, norms, n_sites, threebody_cutoff):
+    cos = np.empty(np.sum(n_sites**2), dtype=bond_vec.dtype)
+    n = 0
     start_index = 0
-    cos = []
     for n_site in n_sites:
         for i in range(n_site):
             for j in range(n_site):
                 if i == j:
                     continue
-                vi = graph.edata["bond_vec"][i + start_index].detach().numpy()
-                vj = graph.edata["bond_vec"][j + start_index].detach().numpy()
-                di = np.linalg.norm(vi)
-                dj = np.linalg.norm(vj)
+                di = norms[i + start_index]
+                dj = norms[j + start_index]
                 if (di <= threebody_cutoff) and (dj <= threebody_cutoff):
-                    cos.append(vi.dot(vj) / np.linalg.norm(vi) / np.linalg.norm(vj))
+                    vi = bond_vec[i + start_index]
+                    vj = bond_vec[j + start_index]
+                    cos[n] = np.sum(vi * vj) / di / dj
+                    n += 1
         start_index += n_site
-    return cos
+    return cos[:n]
 
 
 class TestCompute:
     def test_compute_pair_vector(self, graph_Mo):
         s1, g1, state1 = graph_Mo
+        g1 = copy.deepcopy(g1)
         lattice = torch.tensor(s1.lattice.matrix, dtype=matgl.float_th).unsqueeze(dim=0)
         g1.edata["pbc_offshift"] = torch.matmul(g1.edata["pbc_offset"], lattice[0])
         g1.ndata["pos"] = g1.ndata["frac_coords"] @ lattice[0]
@@ -76,6 +152,7 @@ class TestCompute:
 
     def test_compute_pair_vector_for_molecule(self, graph_CH4):
         s2, g2, state2 = graph_CH4
+        g2 = copy.deepcopy(g2)
         lattice = torch.tensor(np.identity(3), dtype=matgl.float_th).unsqueeze(dim=0)
         g2.edata["pbc_offshift"] = torch.matmul(g2.edata["pbc_offset"], lattice[0])
         g2.ndata["pos"] = g2.ndata["frac_coords"] @ lattice[0]
@@ -110,64 +187,62 @@ class TestCompute:
 
         np.testing.assert_array_almost_equal(np.sort(d), np.sort(d2))
 
-    def test_compute_angle(self, graph_Mo, graph_CH4):
+    @pytest.mark.parametrize("device", devices)
+    def test_compute_angle(self, graph_Mo, graph_CH4, device):
         s1, g1, state1 = graph_Mo
+        g1 = copy.deepcopy(g1)
         lattice = torch.tensor(s1.lattice.matrix, dtype=matgl.float_th).unsqueeze(dim=0)
         g1.edata["pbc_offshift"] = torch.matmul(g1.edata["pbc_offset"], lattice[0])
         g1.ndata["pos"] = g1.ndata["frac_coords"] @ lattice[0]
         bv, bd = compute_pair_vector_and_distance(g1)
         g1.edata["bond_vec"] = bv
         g1.edata["bond_dist"] = bd
-        cos_loop = _calculate_cos_loop(g1, 4.0)
+        # sorted reference cosines for graph_Mo, checked against the loop oracle in test_cos_Mo_reference
+        cos_loop = np.load(this_dir / "fixtures" / "cos_Mo.npy", mmap_mode="r")
 
-        line_graph = create_line_graph(g1, 4.0)
+        line_graph = create_line_graph(g1, 4.0).to(device)
         line_graph.apply_edges(compute_theta_and_phi)
-        np.testing.assert_array_almost_equal(
-            np.sort(np.array(cos_loop)), np.sort(np.array(line_graph.edata["cos_theta"]))
-        )
+        np.testing.assert_array_almost_equal(cos_loop, np.sort(line_graph.edata["cos_theta"].cpu().numpy()))
 
         # test only compute theta
         line_graph.apply_edges(partial(compute_theta, directed=False))
-        theta = np.arccos(np.clip(cos_loop, -1.0 + 1e-7, 1.0 - 1e-7))
-        np.testing.assert_array_almost_equal(np.sort(theta), np.sort(np.array(line_graph.edata["theta"])), decimal=4)
+        # arccos is decreasing, so the reversed sorted cosines give sorted angles
+        theta = np.arccos(np.clip(cos_loop[::-1], -1.0 + 1e-7, 1.0 - 1e-7))
+        np.testing.assert_array_almost_equal(theta, np.sort(line_graph.edata["theta"].cpu().numpy()), decimal=4)
 
         # test only compute theta with cosine
         _ = line_graph.edata.pop("cos_theta")
         line_graph.apply_edges(partial(compute_theta, cosine=True, directed=False))
-        np.testing.assert_array_almost_equal(
-            np.sort(np.array(cos_loop)), np.sort(np.array(line_graph.edata["cos_theta"]))
-        )
+        np.testing.assert_array_almost_equal(cos_loop, np.sort(line_graph.edata["cos_theta"].cpu().numpy()))
 
         s2, g2, state2 = graph_CH4
+        g2 = copy.deepcopy(g2)
         lattice = torch.tensor(np.identity(3), dtype=matgl.float_th).unsqueeze(dim=0)
         g2.edata["pbc_offshift"] = torch.matmul(g2.edata["pbc_offset"], lattice[0])
         g2.ndata["pos"] = g2.ndata["frac_coords"] @ lattice[0]
         bv, bd = compute_pair_vector_and_distance(g2)
         g2.edata["bond_vec"] = bv
         g2.edata["bond_dist"] = bd
-        cos_loop = _calculate_cos_loop(g2, 2.0)
+        cos_loop = np.sort(_calculate_cos_bmm(g2, 2.0))
 
-        line_graph = create_line_graph(g2, 2.0)
+        line_graph = create_line_graph(g2, 2.0).to(device)
         line_graph.apply_edges(compute_theta_and_phi)
-        np.testing.assert_array_almost_equal(
-            np.sort(np.array(cos_loop)), np.sort(np.array(line_graph.edata["cos_theta"]))
-        )
+        np.testing.assert_array_almost_equal(cos_loop, np.sort(line_graph.edata["cos_theta"].cpu().numpy()))
 
         # test only compute theta
         line_graph.apply_edges(partial(compute_theta, directed=False))
         np.testing.assert_array_almost_equal(
-            np.sort(np.arccos(np.array(cos_loop))), np.sort(np.array(line_graph.edata["theta"]))
+            np.arccos(cos_loop[::-1]), np.sort(line_graph.edata["theta"].cpu().numpy())
         )
 
         # test only compute theta with cosine
         _ = line_graph.edata.pop("cos_theta")
         line_graph.apply_edges(partial(compute_theta, cosine=True, directed=False))
-        np.testing.assert_array_almost_equal(
-            np.sort(np.array(cos_loop)), np.sort(np.array(line_graph.edata["cos_theta"]))
-        )
+        np.testing.assert_array_almost_equal(cos_loop, np.sort(line_graph.edata["cos_theta"].cpu().numpy()))
 
     def test_compute_three_body(self, graph_AcAla3NHMe):
         mol1, g1, _ = graph_AcAla3NHMe
+        g1 = copy.deepcopy(g1)
         lattice = torch.tensor(np.identity(3), dtype=matgl.float_th).unsqueeze(dim=0)
         g1.edata["pbc_offshift"] = torch.matmul(g1.edata["pbc_offset"], lattice[0])
         g1.ndata["pos"] = g1.ndata["frac_coords"] @ lattice[0]
@@ -213,6 +288,7 @@ def test_line_graph_extensive():
 @pytest.mark.parametrize("keep_edata", [True, False])
 def test_remove_edges_by_features(graph_Mo, keep_ndata, keep_edata):
     s1, g1, state1 = graph_Mo
+    g1 = copy.deepcopy(g1)
     lattice = torch.tensor(s1.lattice.matrix, dtype=matgl.float_th).unsqueeze(dim=0)
     g1.edata["pbc_offshift"] = torch.matmul(g1.edata["pbc_offset"], lattice[0])
     g1.ndata["pos"] = g1.ndata["frac_coords"] @ lattice[0]
@@ -230,10 +306,11 @@ def test_remove_edges_by_features(graph_Mo, keep_ndata, keep_edata):
         g1, "bond_dist", condition=lambda x: x > new_cutoff, keep_ndata=keep_ndata, keep_edata=keep_edata
     )
     valid_edges = g1.edata["bond_dist"] <= new_cutoff
+    valid_edge_ids = valid_edges.nonzero(as_tuple=False).squeeze()
 
     assert new_g.num_edges() == g2.num_edges()
     assert new_g.num_nodes() == g2.num_nodes()
-    assert torch.allclose(new_g.edata["edge_ids"], valid_edges.nonzero().squeeze())
+    assert torch.equal(new_g.edata["edge_ids"], valid_edge_ids)
 
     if keep_ndata:
         assert new_g.ndata.keys() == g1.ndata.keys()
@@ -241,13 +318,15 @@ def test_remove_edges_by_features(graph_Mo, keep_ndata, keep_edata):
     if keep_edata:
         for key in g1.edata:
             if key != "edge_ids":
-                assert torch.allclose(new_g.edata[key], g1.edata[key][valid_edges])
+                assert torch.equal(new_g.edata[key], g1.edata[key][valid_edge_ids])
 
 
 @pytest.mark.parametrize("cutoff", [2.0, 3.0, 4.0])
 @pytest.mark.parametrize("graph_data", ["graph_Mo", "graph_CH4", "graph_MoS", "graph_LiFePO4", "graph_MoSH"])
-def test_directed_line_graph(graph_data, cutoff, request):
+@pytest.mark.parametrize("device", devices)
+def test_directed_line_graph(graph_data, cutoff, device, request):
     s1, g1, state1 = request.getfixturevalue(graph_data)
+    g1 = copy.deepcopy(g1)
     lattice = (
         torch.tensor(s1.lattice.matrix, dtype=matgl.float_th).unsqueeze(dim=0)
         if graph_data != "graph_CH4"
@@ -258,19 +337,22 @@ def test_directed_line_graph(graph_data, cutoff, request):
     bv, bd = compute_pair_vector_and_distance(g1)
     g1.edata["bond_vec"] = bv
     g1.edata["bond_dist"] = bd
-    cos_loop = _calculate_cos_loop(g1, cutoff)
+    cos_loop = _calculate_cos(g1, cutoff)
     theta_loop = np.arccos(np.clip(cos_loop, -1.0 + 1e-7, 1.0 - 1e-7))
 
-    line_graph = create_line_graph(g1, cutoff, directed=True)
+    line_graph = create_line_graph(g1, cutoff, directed=True).to(device)
     line_graph.apply_edges(compute_theta)
 
     # this test might be lax with just 4 decimal places
-    np.testing.assert_array_almost_equal(np.sort(theta_loop), np.sort(np.array(line_graph.edata["theta"])), decimal=4)
+    np.testing.assert_array_almost_equal(
+        np.sort(theta_loop), np.sort(line_graph.edata["theta"].cpu().numpy()), decimal=4
+    )
 
 
 @pytest.mark.parametrize("graph_data", ["graph_Mo", "graph_CH4", "graph_LiFePO4", "graph_MoSH"])
 def test_ensure_directed_line_graph_compat(graph_data, request):
     s, g, state = request.getfixturevalue(graph_data)
+    g = copy.deepcopy(g)
     lattice = (
         torch.tensor(s.lattice.matrix, dtype=matgl.float_th).unsqueeze(dim=0)
         if graph_data != "graph_CH4"
@@ -297,3 +379,38 @@ def test_ensure_directed_line_graph_compat(graph_data, request):
 
     with pytest.raises(RuntimeError):
         ensure_line_graph_compatibility(g, line_graph, 1.0, directed=True)
+
+
+@pytest.mark.parametrize("cutoff", [2.0, 4.0])
+@pytest.mark.parametrize("graph_data", ["graph_Mo", "graph_CH4", "graph_LiFePO4", "graph_MoSH"])
+def test_loop_indices(graph_data, cutoff, request):
+    _, g, _ = request.getfixturevalue(graph_data)
+    bond_atom_indices = torch.stack(g.edges(), dim=1).numpy()
+    pair_dist = g.edata["bond_dist"].numpy()
+    lg = create_line_graph(g, cutoff)
+    # line graph nodes are the edges within the cutoff, so map them back to the edge ids of g
+    edge_ids = torch.nonzero(g.edata["bond_dist"] <= cutoff)[:, 0].numpy()
+    pairs = np.stack([edge_ids[lg.edges()[0].numpy()], edge_ids[lg.edges()[1].numpy()]], axis=1)
+    indices = _loop_indices(bond_atom_indices, pair_dist, cutoff)
+    np.testing.assert_array_equal(pairs[np.lexsort(pairs.T[::-1])], indices[np.lexsort(indices.T[::-1])])
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("cutoff", [2.0, 4.0])
+@pytest.mark.parametrize("graph_data", ["graph_Mo", "graph_CH4", "graph_LiFePO4", "graph_MoSH"])
+def test_calculate_cos(graph_data, cutoff, request):
+    _, g, _ = request.getfixturevalue(graph_data)
+    cos_loop = _calculate_cos_loop(g, cutoff)
+    np.testing.assert_array_almost_equal(_calculate_cos(g, cutoff), cos_loop)
+    np.testing.assert_array_almost_equal(_calculate_cos_bmm(g, cutoff), cos_loop)
+
+
+@pytest.mark.slow
+def test_cos_Mo_reference(graph_Mo):
+    """Run with --runslow and MATGL_REGEN_FIXTURES=1 to regenerate fixtures/cos_Mo.npy from the loop oracle."""
+    _, g, _ = graph_Mo
+    cos_loop = np.sort(_calculate_cos_loop(g, 4.0))
+    fixture = this_dir / "fixtures" / "cos_Mo.npy"
+    if os.environ.get("MATGL_REGEN_FIXTURES"):
+        np.save(fixture, cos_loop)
+    np.testing.assert_array_almost_equal(cos_loop, np.load(fixture))
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import logging
 import os
 import shutil
 from pathlib import Path
@@ -49,6 +50,13 @@ def test_remote_file():
     ) as s:
         d = torch.load(s, map_location=torch.device("cpu"))
         assert "nblocks" in d["model"]["init_args"]
+    remote_file = RemoteFile(
+        "https://github.com/materialsvirtuallab/matgl/raw/main/pretrained_models/MEGNet-MP-2018.6.1-Eform/model.pt",
+        cache_location=".",
+        check_stale=True,
+    )
+    assert remote_file.etag_path.exists()
+    assert remote_file.local_path.exists()
     try:  # cleanup
         shutil.rmtree("MEGNet-MP-2018.6.1-Eform")
     except FileNotFoundError:
@@ -62,6 +70,155 @@ def test_remote_file():
     assert not os.path.exists("bad_name")  # Ensure that the bad_name folder is not created.
 
 
+class _FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        yield self.content
+
+
+def test_remote_file_check_stale(tmp_path, monkeypatch):
+    sent_headers = []
+    responses = [
+        _FakeResponse(200, b"v1", {"ETag": '"v1"'}),
+        _FakeResponse(304),
+        _FakeResponse(200, b"v2", {"ETag": '"v2"'}),
+    ]
+
+    def fake_get(uri, headers=None, **kwargs):
+        sent_headers.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr("matgl.utils.io._SESSION.get", fake_get)
+    uri = "https://example.com/pretrained_models/SomeModel/model.pt"
+
+    remote_file = RemoteFile(uri, cache_location=tmp_path)
+    assert sent_headers[-1] == {}
+    assert remote_file.local_path.read_bytes() == b"v1"
+    assert remote_file.etag_path.read_text() == '"v1"'
+    mtime = os.stat(remote_file.local_path).st_mtime_ns
+
+    # 304: the cached file is kept untouched.
+    remote_file = RemoteFile(uri, cache_location=tmp_path, check_stale=True)
+    assert sent_headers[-1] == {"If-None-Match": '"v1"'}
+    assert remote_file.local_path.read_bytes() == b"v1"
+    assert os.stat(remote_file.local_path).st_mtime_ns == mtime
+
+    # 200: the cached file and its ETag are replaced.
+    remote_file = RemoteFile(uri, cache_location=tmp_path, check_stale=True)
+    assert sent_headers[-1] == {"If-None-Match": '"v1"'}
+    assert remote_file.local_path.read_bytes() == b"v2"
+    assert remote_file.etag_path.read_text() == '"v2"'
+    assert not responses
+
+
+def test_remote_file_check_stale_last_modified(tmp_path, monkeypatch, caplog):
+    sent_headers = []
+    last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+    responses = [
+        _FakeResponse(200, b"v1", {"Last-Modified": last_modified}),
+        _FakeResponse(304),
+        _FakeResponse(200, b"v2"),
+        _FakeResponse(200, b"v3"),
+    ]
+
+    def fake_get(uri, headers=None, **kwargs):
+        sent_headers.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr("matgl.utils.io._SESSION.get", fake_get)
+    uri = "https://example.com/pretrained_models/SomeModel/model.pt"
+
+    remote_file = RemoteFile(uri, cache_location=tmp_path)
+    assert not remote_file.etag_path.exists()
+    assert remote_file.last_modified_path.read_text() == last_modified
+
+    # Without an ETag, If-Modified-Since is used for the conditional request.
+    remote_file = RemoteFile(uri, cache_location=tmp_path, check_stale=True)
+    assert sent_headers[-1] == {"If-Modified-Since": last_modified}
+    assert remote_file.local_path.read_bytes() == b"v1"
+
+    remote_file = RemoteFile(uri, cache_location=tmp_path, check_stale=True)
+    assert remote_file.local_path.read_bytes() == b"v2"
+    assert not remote_file.last_modified_path.exists()
+
+    # Without any stored validator, the file is re-downloaded in full with a warning.
+    with caplog.at_level(logging.WARNING):
+        remote_file = RemoteFile(uri, cache_location=tmp_path, check_stale=True)
+    assert sent_headers[-1] == {}
+    assert remote_file.local_path.read_bytes() == b"v3"
+    assert "Re-downloading in full" in caplog.text
+
+
+def test_remote_file_fetch_many(tmp_path, monkeypatch):
+    contents = {"model.pt": b"model", "state.pt": b"state", "model.json": b"{}"}
+
+    def fake_get(uri, headers=None, **kwargs):
+        fname = uri.split("/")[-1]
+        if fname in contents:
+            return _FakeResponse(200, contents[fname], {"ETag": f'"{fname}"'})
+        return _FakeResponse(404)
+
+    monkeypatch.setattr("matgl.utils.io._SESSION.get", fake_get)
+    base_uri = "https://example.com/pretrained_models/SomeModel/"
+
+    remote_files = RemoteFile.fetch_many([base_uri + fn for fn in contents], cache_location=tmp_path)
+    assert [remote_file.fname for remote_file in remote_files] == list(contents)
+    assert [remote_file.local_path.read_bytes() for remote_file in remote_files] == list(contents.values())
+
+    # Files downloaded before a sibling failed are removed, while files already in the cache are kept.
+    uris = [base_uri + fn for fn in ("model.pt", "missing.pt", "new.pt")]
+    contents["new.pt"] = b"new"
+    with pytest.raises(requests.RequestException, match="Bad uri:.*missing.pt"):
+        RemoteFile.fetch_many(uris, cache_location=tmp_path)
+    assert sorted(os.listdir(tmp_path / "SomeModel")) == [
+        "model.json",
+        "model.json.etag",
+        "model.pt",
+        "model.pt.etag",
+        "state.pt",
+        "state.pt.etag",
+    ]
+
+
+def test_remote_file_local(monkeypatch):
+    path = (this_dir / ".." / ".." / "pretrained_models" / "MEGNet-MP-2018.6.1-Eform" / "model.pt").resolve()
+    for uri in (str(path), path.as_uri()):
+        remote_file = RemoteFile(uri, cache_location=".")
+        assert remote_file.local_path == path
+        with remote_file as s:
+            d = torch.load(s, map_location=torch.device("cpu"))
+            assert "nblocks" in d["model"]["init_args"]
+    assert not os.path.exists("MEGNet-MP-2018.6.1-Eform")  # Local files are not copied into the cache.
+
+    uris = [str(path.with_name(fn)) for fn in ("model.pt", "state.pt", "model.json")]
+    remote_files = RemoteFile.fetch_many(uris, cache_location=".")
+    assert [str(remote_file.local_path) for remote_file in remote_files] == uris
+
+    with pytest.raises(requests.RequestException, match="Bad uri:"):
+        _ = RemoteFile(str(this_dir / "bad_name" / "model.pt"), cache_location=".")
+
+    # A bare relative filename is also a valid local path.
+    monkeypatch.chdir(path.parent)
+    remote_file = RemoteFile("model.pt")
+    assert remote_file.local_path == Path("model.pt")
+    assert (remote_file.model_name, remote_file.fname) == ("MEGNet-MP-2018.6.1-Eform", "model.pt")
+    assert remote_file.cache_location is None
+    assert remote_file.etag_path is None
+    with remote_file as s:
+        d = torch.load(s, map_location=torch.device("cpu"))
+        assert "nblocks" in d["model"]["init_args"]
+
+
 def test_get_available_pretrained_models():
     model_names = get_available_pretrained_models()
     assert len(model_names) > 1